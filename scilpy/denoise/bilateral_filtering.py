@@ -16,7 +16,8 @@ def angle_aware_bilateral_filtering(in_sh, sh_order=8,
                                     sigma_angular=1.0,
                                     sigma_range=0.5,
                                     use_gpu=True,
-                                    nbr_processes=1):
+                                    nbr_processes=1,
+                                    z_chunk_size=None):
     """
     Angle-aware bilateral filtering.
 
@@ -42,6 +43,9 @@ def angle_aware_bilateral_filtering(in_sh, sh_order=8,
         True if GPU should be used.
     nbr_processes: int, optional
         Number of processes to use.
+    z_chunk_size: int, optional
+        Number of slices along the z axis processed at once on the GPU.
+        If None, the whole volume is processed at once.
 
     Returns
     -------
@@ -52,7 +56,8 @@ def angle_aware_bilateral_filtering(in_sh, sh_order=8,
         return angle_aware_bilateral_filtering_gpu(in_sh, sh_order,
                                                    sh_basis, in_full_basis,
                                                    sphere_str, sigma_spatial,
-                                                   sigma_angular, sigma_range)
+                                                   sigma_angular, sigma_range,
+                                                   z_chunk_size)
     elif use_gpu and not have_opencl:
         raise RuntimeError('Package pyopencl not found. Install pyopencl'
                            ' or set use_gpu to False.')
@@ -70,10 +75,16 @@ def angle_aware_bilateral_filtering_gpu(in_sh, sh_order=8,
                                         sphere_str='repulsion724',
                                         sigma_spatial=1.0,
                                         sigma_angular=1.0,
-                                        sigma_range=0.5):
+                                        sigma_range=0.5,
+                                        z_chunk_size=None):
     """
     Angle-aware bilateral filtering using OpenCL for GPU computing.
 
+    The volume can be processed in chunks of slices along the z axis to
+    limit the amount of memory required on the GPU. Each chunk is padded
+    with the neighbouring slices covered by the spatial filter, so the
+    output is identical to processing the whole volume at once.
+
     Parameters
     ----------
     in_sh: ndarray (x, y, z, ncoeffs)
@@ -92,6 +103,9 @@ def angle_aware_bilateral_filtering_gpu(in_sh, sh_order=8,
         Standard deviation for angular filter.
     sigma_range: float, optional
         Standard deviation for range filter.
+    z_chunk_size: int, optional
+        Number of slices along the z axis processed at once on the GPU.
+        If None, the whole volume is processed at once.
 
     Returns
     -------
@@ -120,15 +134,23 @@ def angle_aware_bilateral_filtering_gpu(in_sh, sh_order=8,
     out_n_coeffs = sf_to_sh_mat.shape[1]
     n_dirs = len(sphere.vertices)
     volume_shape = in_sh.shape
+    if z_chunk_size is None:
+        z_chunk_size = volume_shape[2]
+
+    # The last chunk is padded with empty slices up to z_chunk_size, so a
+    # single program and set of buffers is used for all the chunks. Its
+    # extra output slices are cropped.
+    n_chunks = int(np.ceil(volume_shape[2] / z_chunk_size))
+    z_extra = n_chunks * z_chunk_size - volume_shape[2]
     in_sh = np.pad(in_sh, ((h_half_width, h_half_width),
                            (h_half_width, h_half_width),
-                           (h_half_width, h_half_width),
+                           (h_half_width, h_half_width + z_extra),
                            (0, 0)))
 
     cl_kernel = CLKernel('correlate', 'denoise', 'angle_aware_bilateral.cl')
     cl_kernel.set_define('IM_X_DIM', volume_shape[0])
     cl_kernel.set_define('IM_Y_DIM', volume_shape[1])
-    cl_kernel.set_define('IM_Z_DIM', volume_shape[2])
+    cl_kernel.set_define('IM_Z_DIM', z_chunk_size)
 
     cl_kernel.set_define('H_X_DIM', h_weights.shape[0])
     cl_kernel.set_define('H_Y_DIM', h_weights.shape[1])
@@ -140,17 +162,29 @@ def angle_aware_bilateral_filtering_gpu(in_sh, sh_order=8,
     cl_kernel.set_define('OUT_N_COEFFS', out_n_coeffs)
     cl_kernel.set_define('N_DIRS', n_dirs)
 
+    chunk_shape = volume_shape[:2] + (z_chunk_size,)
     cl_manager = CLManager(cl_kernel, 4, 1)
-    cl_manager.add_input_buffer(0, in_sh)
     cl_manager.add_input_buffer(1, h_weights)
     cl_manager.add_input_buffer(2, sh_to_sf_mat)
     cl_manager.add_input_buffer(3, sf_to_sh_mat)
 
-    cl_manager.add_output_buffer(0, volume_shape[:3] + (out_n_coeffs,),
+    cl_manager.add_output_buffer(0, chunk_shape + (out_n_coeffs,),
                                  np.float32)
 
-    outputs = cl_manager.run(volume_shape[:3])
-    return outputs[0]
+    out_sh = np.zeros(volume_shape[:3] + (out_n_coeffs,), dtype=np.float32)
+    for z_start in range(0, volume_shape[2], z_chunk_size):
+        z_stop = min(z_start + z_chunk_size, volume_shape[2])
+
+        # The padded volume is offset by h_half_width, so this slab
+        # contains the chunk and the slices needed by the filter around it.
+        in_chunk = in_sh[:, :, z_start:z_start + z_chunk_size +
+                         2 * h_half_width]
+        cl_manager.add_input_buffer(0, in_chunk)
+
+        outputs = cl_manager.run(chunk_shape)
+        out_sh[:, :, z_start:z_stop] = outputs[0][:, :, :z_stop - z_start]
+
+    return out_sh
 
 
 def angle_aware_bilateral_filtering_cpu(in_sh, sh_order=8,
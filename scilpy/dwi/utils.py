@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -7,31 +8,37 @@ from scilpy.gradients.bvec_bval_tools import get_shell_indices, B0ExtractionStra
 from scilpy.image.utils import volume_iterator
 
 
-def _rescale_intensity(val, slope, in_max, bc_max):
+def _get_min_max(data, block_size=65536):
     """
-    Rescale an intensity value given a scaling factor.
-    This scaling factor ensures that the intensity
-    range before and after correction is the same.
+    Compute the minimum and maximum of an array in a single pass.
+    The array is reduced by blocks along its first axis, so each block is
+    still in cache when its maximum is computed after its minimum.
 
     Parameters
     ----------
-    val: float
-         Value to be scaled
-    scale: float
-         Scaling factor to be applied
-    in_max: float
-         Max possible value
-    bc_max: float
-         Max value in the bias correction value range
+    data: ndarray
+         Input array.
+    block_size: int
+         Approximate number of elements reduced at once.
 
     Returns
     -------
-    rescaled_value: float
-         Bias field corrected value scaled by the slope
-         of the data
+    min_max: tuple of float
+         Minimum and maximum values of the array.
     """
+    data = np.asarray(data)
+    if data.ndim == 0 or len(data) == 0:
+        return np.amin(data), np.amax(data)
 
-    return in_max - slope * (bc_max - val)
+    step = max(1, block_size // max(1, data[0].size))
+    block_mins, block_maxs = [], []
+    for i in range(0, len(data), step):
+        block = data[i:i + step]
+        block_mins.append(np.amin(block))
+        block_maxs.append(np.amax(block))
+
+    # Reduced with numpy, like np.amin / np.amax, so NaNs are propagated
+    return np.minimum.reduce(block_mins), np.maximum.reduce(block_maxs)
 
 
 # https://github.com/stnava/ANTs/blob/master/Examples/N4BiasFieldCorrection.cxx
@@ -55,25 +62,85 @@ def rescale_dwi(in_data, bc_data):
          Bias field corrected DWI volume
     """
 
-    in_min = np.amin(in_data)
-    in_max = np.amax(in_data)
-    bc_min = np.amin(bc_data)
-    bc_max = np.amax(bc_data)
+    # Work in float32 on a contiguous array so the passes below touch as
+    # little memory as possible.
+    in_data = np.asarray(in_data, dtype=np.float32)
+    bc_data = np.ascontiguousarray(bc_data, dtype=np.float32)
 
-    slope = (in_max - in_min) / (bc_max - bc_min)
+    in_min, in_max = _get_min_max(in_data)
+    bc_min, bc_max = _get_min_max(bc_data)
 
-    chunk = np.arange(0, len(in_data), 100000)
-    chunk = np.append(chunk, len(in_data))
-    for i in range(len(chunk)-1):
-        nz_bc_data = bc_data[chunk[i]:chunk[i+1]]
-        rescale_func = np.vectorize(_rescale_intensity, otypes=[np.float32])
+    slope = (in_max - in_min) / (bc_max - bc_min)
 
-        rescaled_data = rescale_func(nz_bc_data, slope, in_max, bc_max)
-        bc_data[chunk[i]:chunk[i+1]] = rescaled_data
+    # Equivalent to in_max - slope * (bc_max - bc_data), rewritten as
+    # slope * bc_data + offset so it takes two in-place passes over the
+    # data without allocating temporaries.
+    offset = in_max - slope * bc_max
+    np.multiply(bc_data, slope, out=bc_data)
+    np.add(bc_data, offset, out=bc_data)
 
     return bc_data
 
 
+def _prefetch(iterable):
+    """
+    Iterate over an iterable while a background thread loads the next item.
+    Used to read the next block of volumes from disk while the current one
+    is processed, so at most two blocks are in memory at once. Exceptions
+    raised while loading are raised again in the calling thread.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Iterable to consume, typically a volume_iterator.
+
+    Yields
+    ------
+    item
+        The items of the iterable, in the same order.
+    """
+    iterator = iter(iterable)
+    done = object()
+
+    # A single pending read. If the caller stops early, leaving the with
+    # block waits for it to finish and nothing else is read.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, done)
+        while True:
+            item = future.result()
+            if item is done:
+                break
+            future = executor.submit(next, iterator, done)
+            yield item
+            del item
+
+
+def _load_volumes(dwi, indices):
+    """
+    Load a subset of the volumes of a 4D image. If the image data is already
+    in memory, the cached data is indexed. Otherwise, the smallest contiguous
+    range of volumes containing them is read once from the file.
+
+    Parameters
+    ----------
+    dwi : nib.Nifti1Image
+        Image of a 4D volume with shape X,Y,Z,N
+    indices : ndarray
+        Sorted indices of the volumes to load.
+
+    Returns
+    -------
+    data : ndarray
+        The selected volumes as a 4D float32 array.
+    """
+    if dwi.in_memory:
+        return dwi.get_fdata(dtype=np.float32)[..., indices]
+
+    start, stop = indices[0], indices[-1] + 1
+    data = np.asarray(dwi.dataobj[..., start:stop], dtype=np.float32)
+    return data[..., indices - start]
+
+
 def extract_dwi_shell(dwi, bvals, bvecs, bvals_to_extract, tol=20,
                       block_size=None):
     """Extracts the DWI volumes that are on specific b-value shells. Many
@@ -118,9 +185,9 @@ def extract_dwi_shell(dwi, bvals, bvecs, bvals_to_extract, tol=20,
         Selected b-vectors.
 
     """
-    indices = [get_shell_indices(bvals, shell, tol=tol)
-               for shell in bvals_to_extract]
-    indices = np.unique(np.sort(np.hstack(indices)))
+    shell_indices = [get_shell_indices(bvals, shell, tol=tol)
+                     for shell in bvals_to_extract]
+    indices = np.unique(np.concatenate(shell_indices))
 
     if len(indices) == 0:
         raise ValueError("There are no volumes that have the supplied b-values"
@@ -130,21 +197,27 @@ def extract_dwi_shell(dwi, bvals, bvecs, bvals_to_extract, tol=20,
         "Extracting shells [{}], with number of images per shell [{}], "
         "from {} images from {}."
         .format(" ".join([str(b) for b in bvals_to_extract]),
-                " ".join([str(len(get_shell_indices(bvals, shell, tol=tol)))
-                          for shell in bvals_to_extract]),
+                " ".join([str(len(idx)) for idx in shell_indices]),
                 len(bvals), dwi.get_filename()))
 
     if block_size is None:
-        block_size = dwi.shape[-1]
-
-    # Load the shells by iterating through blocks of volumes. This approach
-    # is slower for small files, but allows very big files to be split
-    # with less memory usage.
-    shell_data = np.zeros((dwi.shape[:-1] + (len(indices),)))
-    for vi, data in volume_iterator(dwi, block_size):
-        in_volume = np.array([i in vi for i in indices])
-        in_data = np.array([i in indices for i in vi])
-        shell_data[..., in_volume] = data[..., in_data]
+        shell_data = _load_volumes(dwi, indices)
+    else:
+        # Load the shells by iterating through blocks of volumes. This
+        # approach is slower for small files, but allows very big files to
+        # be split with less memory usage.
+        shell_data = np.zeros(dwi.shape[:-1] + (len(indices),),
+                              dtype=np.float32)
+        in_shell = np.zeros(dwi.shape[-1], dtype=bool)
+        in_shell[indices] = True
+        for vi, data in _prefetch(volume_iterator(dwi, block_size)):
+            # Blocks are contiguous ranges of volumes and indices are
+            # sorted, so the selected volumes of a block are contiguous
+            # in shell_data.
+            first = np.searchsorted(indices, vi[0])
+            last = np.searchsorted(indices, vi[-1], side='right')
+            in_data = in_shell[vi[0]:vi[-1] + 1]
+            shell_data[..., first:last] = data[..., in_data]
 
     output_bvals = bvals[indices].astype(int)
     output_bvals.shape = (1, len(output_bvals))
@@ -184,53 +257,86 @@ def extract_b0(dwi, b0_mask, extract_in_cluster=False,
 
     indices = np.where(b0_mask)[0]
 
-    if block_size is None:
-        block_size = dwi.shape[-1]
-
     if not extract_in_cluster and strategy == B0ExtractionStrategy.FIRST:
         idx = np.min(indices)
         output_b0 = dwi.dataobj[..., idx:idx + 1].squeeze()
     else:
-        # Generate list of clustered b0 in the data
-        mask = np.ma.masked_array(b0_mask)
-        mask[~b0_mask] = np.ma.masked
-        b0_clusters = np.ma.notmasked_contiguous(mask, axis=0)
+        # Generate list of clustered b0 in the data. Clusters start where
+        # the mask goes from False to True and stop where it goes back.
+        edges = np.diff(np.concatenate(
+            ([0], np.asarray(b0_mask, dtype=np.int8), [0])))
+        b0_clusters = [slice(start, stop) for start, stop in
+                       zip(np.flatnonzero(edges == 1),
+                           np.flatnonzero(edges == -1))]
+
+        if block_size is None and strategy != B0ExtractionStrategy.FIRST:
+            # Everything fits in memory, read all the b0 volumes at once
+            b0_data = _load_volumes(dwi, indices)
 
-        if extract_in_cluster or strategy == B0ExtractionStrategy.ALL:
+            if strategy == B0ExtractionStrategy.ALL:
+                output_b0 = b0_data
+            elif extract_in_cluster:
+                # Position of the first volume of each cluster in b0_data
+                lengths = np.array([cluster.stop - cluster.start
+                                    for cluster in b0_clusters])
+                firsts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+                output_b0 = np.add.reduceat(b0_data, firsts, axis=-1)
+                output_b0 /= lengths.astype(np.float32)
+            else:
+                output_b0 = np.mean(b0_data, -1, dtype=np.float32)
+
+        elif extract_in_cluster or strategy == B0ExtractionStrategy.ALL:
             if strategy == B0ExtractionStrategy.ALL:
                 time_d = len(indices)
             else:
                 time_d = len(b0_clusters)
 
-            output_b0 = np.zeros(dwi.shape[:-1] + (time_d,))
+            output_b0 = np.zeros(dwi.shape[:-1] + (time_d,),
+                                 dtype=np.float32)
+            if strategy == B0ExtractionStrategy.MEAN:
+                block_sum = np.empty(dwi.shape[:-1], dtype=np.float32)
 
             for idx, cluster in enumerate(b0_clusters):
                 if strategy == B0ExtractionStrategy.FIRST:
                     data = dwi.dataobj[..., cluster.start:cluster.start + 1]
                     output_b0[..., idx] = data.squeeze()
+                elif cluster.stop - cluster.start <= block_size:
+                    # The whole cluster fits in a single block, read it at
+                    # once. Its volumes are contiguous in the output.
+                    data = dwi.dataobj[..., cluster.start:cluster.stop]
+                    if strategy == B0ExtractionStrategy.ALL:
+                        first = np.searchsorted(indices, cluster.start)
+                        output_b0[..., first:first + data.shape[-1]] = data
+                    elif strategy == B0ExtractionStrategy.MEAN:
+                        output_b0[..., idx] = np.mean(data, -1,
+                                                      dtype=np.float32)
                 else:
                     vol_it = volume_iterator(dwi, block_size,
                                              cluster.start, cluster.stop)
 
-                    for vi, data in vol_it:
+                    for vi, data in _prefetch(vol_it):
                         if strategy == B0ExtractionStrategy.ALL:
-                            in_volume = np.array([i in vi for i in indices])
-                            output_b0[..., in_volume] = data
+                            first = np.searchsorted(indices, vi[0])
+                            output_b0[..., first:first + len(vi)] = data
                         elif strategy == B0ExtractionStrategy.MEAN:
-                            output_b0[..., idx] += np.sum(data, -1)
-
-                    if strategy == B0ExtractionStrategy.MEAN:
-                        output_b0[..., idx] /= cluster.stop - cluster.start
+                            # Normalize each block before accumulating it
+                            # to avoid a final pass over the output.
+                            np.sum(data, -1, dtype=np.float32,
+                                   out=block_sum)
+                            block_sum /= cluster.stop - cluster.start
+                            output_b0[..., idx] += block_sum
 
         else:
-            output_b0 = np.zeros(dwi.shape[:-1])
+            output_b0 = np.zeros(dwi.shape[:-1], dtype=np.float32)
+            block_sum = np.empty(dwi.shape[:-1], dtype=np.float32)
             for cluster in b0_clusters:
                 vol_it = volume_iterator(dwi, block_size,
                                          cluster.start, cluster.stop)
 
-                for _, data in vol_it:
-                    output_b0 += np.sum(data, -1)
-
-            output_b0 /= len(indices)
+                for _, data in _prefetch(vol_it):
+                    np.sum(data, -1, dtype=np.float32, out=block_sum)
+                    block_sum /= len(indices)
+                    output_b0 += block_sum
 
     return output_b0
@@ -21,11 +21,13 @@ def save_gradient_sampling_mrtrix(bvecs, shell_idx, bvals, filename):
         output file name
     ------
     """
-    with open(filename, 'w') as f:
-        for idx in range(bvecs.shape[1]):
-            f.write('{:.8f} {:.8f} {:.8f} {:}\n'
-                    .format(bvecs[0, idx], bvecs[1, idx], bvecs[2, idx],
-                            bvals[shell_idx[idx]]))
+    # The b-values keep their own type, integers are written without
+    # decimals
+    bvals = np.asarray(bvals)[np.asarray(shell_idx)].tolist()
+    table = np.column_stack([np.char.mod('%.8f', np.asarray(bvec))
+                             for bvec in bvecs[:3]] +
+                            [[str(b) for b in bvals]])
+    np.savetxt(filename, table, fmt='%s')
 
     logging.info('Gradient sampling saved in MRtrix format as {}'
                  .format(filename))
@@ -53,7 +55,7 @@ def save_gradient_sampling_fsl(bvecs, shell_idx, bvals, filename_bval,
 
     np.savetxt(filename_bvec, bvecs, fmt='%.8f')
     np.savetxt(filename_bval,
-               np.array([bvals[idx] for idx in shell_idx])[None, :],
+               np.asarray(bvals)[np.asarray(shell_idx)][None, :],
                fmt='%.3f')
 
     logging.info('Gradient sampling saved in FSL format as {}'
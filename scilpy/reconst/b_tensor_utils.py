@@ -79,6 +79,8 @@ def generate_btensor_input(in_dwis, in_bvals, in_bvecs,
                 logging.warning('Your b-vectors do not seem normalized...')
                 bvecs = normalize_bvecs(bvecs)
             ubvals = unique_bvals_tolerance(bvals, tol=tol)
+            # Cache the data, every shell is extracted from it
+            vol.get_fdata(dtype=np.float32)
             for ubval in ubvals:  # Loop over all unique bvals
                 # Extracting the data for the ubval shell
                 indices, shell_data, _, output_bvecs = \
@@ -31,36 +31,55 @@ def compute_rish(sh, mask=None, full_basis=False):
         multiple sites and scanners." MICCAI 2015.
         https://scholar.harvard.edu/files/hengameh/files/miccai2015.pdf
     """
+    orders = []
+    features = []
+    for order, feature in compute_rish_iter(sh, mask, full_basis=full_basis):
+        orders.append(order)
+        features.append(feature)
+
+    return np.stack(features, axis=-1), orders
+
+
+def compute_rish_iter(sh, mask=None, full_basis=False):
+    """Generator variant of `compute_rish`, yielding the RISH features one
+    SH order at a time. Only a single 3D feature map is held in memory at
+    once, which is useful when each feature is saved as soon as it is
+    computed.
+
+    Parameters
+    ----------
+    sh : np.ndarray object
+        Array of the SH coefficients
+    mask: np.ndarray object, optional
+        Binary mask. Only data inside the mask will be used for computation.
+    full_basis: bool, optional
+        True when coefficients are for a full SH basis.
+
+    Yields
+    ------
+    tuple of (int, np.ndarray with shape (x,y,z))
+        The SH order and its associated RISH feature map.
+    """
     # Guess SH order
     sh_order = order_from_ncoef(sh.shape[-1], full_basis=full_basis)
 
     # Get degree / order for all indices
-    degree_ids, order_ids = sph_harm_ind_list(sh_order, full_basis=full_basis)
-
-    # Apply mask to input
-    if mask is not None:
-        sh = sh * mask[..., None]
+    _, order_ids = sph_harm_ind_list(sh_order, full_basis=full_basis)
 
     # Get number of indices per order (e.g. for order 6, sym. : [1,5,9,13])
     step = 1 if full_basis else 2
     n_indices_per_order = np.bincount(order_ids)[::step]
 
     # Get start index of each order (e.g. for order 6 : [0,1,6,15])
-    order_positions = np.concatenate([[0], np.cumsum(n_indices_per_order)])[:-1]
-
-    # Get paired indices for np.add.reduceat, specifying where to reduce.
-    # The last index is omitted, it is automatically replaced by len(array)-1
-    # (e.g. for order 6 : [0,1, 1,6, 6,15, 15,])
-    reduce_indices = np.repeat(order_positions, 2)[1:]
-
-    # Compute the sum of squared coefficients using numpy's `reduceat`
-    squared_sh = np.square(sh)
-    rish = np.add.reduceat(squared_sh, reduce_indices, axis=-1)[..., ::2]
-
-    # Apply mask
-    if mask is not None:
-        rish *= mask[..., None]
+    order_positions = np.concatenate([[0], np.cumsum(n_indices_per_order)])
 
     orders = sorted(np.unique(order_ids))
+    for i, order in enumerate(orders):
+        start, stop = order_positions[i], order_positions[i + 1]
+        feature = np.sum(np.square(sh[..., start:stop]), axis=-1)
+
+        # Apply mask
+        if mask is not None:
+            feature *= mask
 
-    return rish, orders
+        yield order, feature
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from numpy.testing import assert_almost_equal, assert_equal
+
+from scilpy.reconst.sh import compute_rish, compute_rish_iter
+
+
+def _get_sh(n_coefs):
+    return np.random.RandomState(1234).rand(4, 3, 2, n_coefs)
+
+
+def test_compute_rish_iter():
+    # Symmetric basis of order 2: [1, 5] coefficients per order
+    sh = _get_sh(6)
+    features = list(compute_rish_iter(sh))
+
+    assert_equal([order for order, _ in features], [0, 2])
+    assert_almost_equal(features[0][1], np.square(sh[..., 0]))
+    assert_almost_equal(features[1][1],
+                        np.sum(np.square(sh[..., 1:]), axis=-1))
+
+
+def test_compute_rish_iter_full_basis():
+    # Full basis of order 2: [1, 3, 5] coefficients per order
+    sh = _get_sh(9)
+    features = list(compute_rish_iter(sh, full_basis=True))
+
+    assert_equal([order for order, _ in features], [0, 1, 2])
+    assert_almost_equal(features[1][1],
+                        np.sum(np.square(sh[..., 1:4]), axis=-1))
+    assert_almost_equal(features[2][1],
+                        np.sum(np.square(sh[..., 4:]), axis=-1))
+
+
+def test_compute_rish():
+    sh = _get_sh(15)
+    mask = np.zeros(sh.shape[:-1])
+    mask[1:3, :, 0] = 1
+
+    rish, orders = compute_rish(sh, mask)
+
+    assert_equal(rish.shape, sh.shape[:-1] + (3,))
+    assert_equal(orders, [0, 2, 4])
+    assert_equal(rish[mask == 0], 0)
+    for i, (_, feature) in enumerate(compute_rish_iter(sh, mask)):
+        assert_almost_equal(rish[..., i], feature)
+    assert_almost_equal(rish[..., 2][mask == 1],
+                        np.sum(np.square(sh[..., 6:]), axis=-1)[mask == 1])
@@ -27,7 +27,7 @@ import numpy as np
 from scilpy.io.image import get_data_as_mask
 from scilpy.io.utils import (add_overwrite_arg, assert_inputs_exist,
                              assert_outputs_exist)
-from scilpy.reconst.sh import compute_rish
+from scilpy.reconst.sh import compute_rish_iter
 
 
 def _build_arg_parser():
@@ -56,7 +56,7 @@ def main():
 
     # Load data
     sh_img = nib.load(args.in_sh)
-    sh = sh_img.get_fdata(dtype=np.float32)
+    sh = np.asarray(sh_img.dataobj, dtype=np.float32)
     mask = None
     if args.mask:
         mask = get_data_as_mask(nib.load(args.mask), dtype=bool)
@@ -68,15 +68,16 @@ def main():
     output_fnames = ["{}{}.nii.gz".format(args.out_prefix, i) for i in orders]
     assert_outputs_exist(parser, args, output_fnames)
 
-    # Compute RISH features
-    rish, final_orders = compute_rish(sh, mask, full_basis=args.full_basis)
-
-    # Make sure the precomputed orders match the orders returned
-    assert np.all(orders == np.array(final_orders))
-
-    # Save each RISH feature as a separate file
-    for i, fname in enumerate(output_fnames):
-        nib.save(nib.Nifti1Image(rish[..., i], sh_img.affine), fname)
+    # Compute RISH features and save each one as a separate file as soon as
+    # it is computed, so only one feature map is held in memory at a time.
+    rish_it = compute_rish_iter(sh, mask, full_basis=args.full_basis)
+    # The number of orders yielded must match the precomputed outputs
+    for (order, feature), expected_order, fname in zip(rish_it, orders,
+                                                       output_fnames,
+                                                       strict=True):
+        # Make sure the precomputed orders match the orders returned
+        assert order == expected_order
+        nib.save(nib.Nifti1Image(feature, sh_img.affine), fname)
 
 
 if __name__ == '__main__':
@@ -74,6 +74,11 @@ def _build_arg_parser():
     p.add_argument('--use_gpu', action='store_true',
                    help='Use GPU for computation.')
 
+    p.add_argument('--z_chunk_size', type=int,
+                   help='Number of slices along the z axis to process at '
+                        'once on the GPU.\nUse when the whole volume does '
+                        'not fit in GPU memory. [All slices]')
+
     add_verbose_arg(p)
     add_overwrite_arg(p)
     add_processes_arg(p)
@@ -96,9 +101,15 @@ def main():
 
     nbr_processes = validate_nbr_processes(parser, args)
 
+    if args.z_chunk_size is not None:
+        if not args.use_gpu:
+            parser.error('Option --z_chunk_size requires --use_gpu.')
+        if args.z_chunk_size < 1:
+            parser.error('Option --z_chunk_size must be greater than 0.')
+
     # Prepare data
     sh_img = nib.load(args.in_sh)
-    data = sh_img.get_fdata(dtype=np.float32)
+    data = np.asarray(sh_img.dataobj, dtype=np.float32)
 
     sh_order, full_basis = get_sh_order_and_fullness(data.shape[-1])
 
@@ -113,7 +124,8 @@ def main():
         sigma_angular=args.sigma_angular,
         sigma_range=args.sigma_range,
         use_gpu=args.use_gpu,
-        nbr_processes=nbr_processes)
+        nbr_processes=nbr_processes,
+        z_chunk_size=args.z_chunk_size)
     t1 = time.perf_counter()
     logging.info('Elapsed time (s): {0}'.format(t1 - t0))
 
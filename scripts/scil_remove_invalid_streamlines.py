@@ -76,20 +76,23 @@ def main():
     else:
         sft.remove_invalid_streamlines()
 
-    indices = []
+    invalid = np.zeros(len(sft), dtype=bool)
     if args.remove_single_point:
         # Will try to do a PR in Dipy
-        indices = [i for i in range(len(sft)) if len(sft.streamlines[i]) <= 1]
+        invalid |= sft.streamlines._lengths <= 1
 
     if args.remove_overlapping_points:
-        for i in np.setdiff1d(range(len(sft)), indices):
+        for i in np.flatnonzero(~invalid):
             norm = np.linalg.norm(np.diff(sft.streamlines[i], axis=0),
                                   axis=1)
             if (norm < args.threshold).any():
-                indices.append(i)
+                invalid[i] = True
 
-    indices = np.setdiff1d(range(len(sft)), indices).astype(np.uint32)
-    if len(indices):
+    indices = np.flatnonzero(~invalid)
+    if len(indices) == len(sft):
+        # Nothing to remove, avoid copying the whole tractogram
+        new_sft = sft
+    elif len(indices):
         new_sft = sft[indices]
     else:
         new_sft = StatefulTractogram.from_sft([], sft)
@@ -21,28 +21,38 @@ import os
 import argparse
 from bids import BIDSLayout, BIDSLayoutIndexer
 from bids.layout import Query
-from glob import glob
+from collections import defaultdict
+import fnmatch
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import pathlib
+import re
+import tempfile
+import textwrap
+from types import MappingProxyType
 
 import coloredlogs
 
-from scilpy.io.utils import (add_overwrite_arg, add_verbose_arg,
+from scilpy.io.utils import (add_overwrite_arg, add_processes_arg,
+                             add_verbose_arg,
                              assert_inputs_exist,
-                             assert_outputs_exist)
+                             assert_outputs_exist,
+                             validate_nbr_processes)
 
 
-conversion = {"i": "x",
-              "i-": "x-",
-              "j": "y",
-              "j-": "y-",
-              "k": "z",
-              "k-": "z-",
-              "LR": "x",
-              "RL": "x-",
-              "AP": "y",
-              "PA": "y-"}
+conversion = MappingProxyType({"i": "x",
+                               "i-": "x-",
+                               "j": "y",
+                               "j-": "y-",
+                               "k": "z",
+                               "k-": "z-",
+                               "LR": "x",
+                               "RL": "x-",
+                               "AP": "y",
+                               "PA": "y-"})
 
 
 def _build_arg_parser():
@@ -61,6 +71,18 @@ def _build_arg_parser():
                         "you can provide an extra bidsignore file."
                         "Check: https://github.com/bids-standard/bids-validator#bidsignore")
 
+    p.add_argument('--participants', nargs='+',
+                   help="Only index and validate these participants (labels "
+                        "with or without the 'sub-' prefix).\nThe folders of "
+                        "the other participants are skipped while indexing.")
+
+    p.add_argument('--layout_db',
+                   help="Path of a pybids database for the layout. If it "
+                        "exists, it is loaded instead of indexing the "
+                        "dataset,\notherwise the index is saved there. "
+                        "Delete it when the dataset or the ignore options "
+                        "change.")
+
     p.add_argument("--fs",
                    help='Output freesurfer path. It will add keys wmparc and '
                         'aparc+aseg.')
@@ -73,14 +95,62 @@ def _build_arg_parser():
     p.add_argument("--readout", type=float, default=0.062,
                    help="Default total readout time value [%(default)s].")
 
+    add_processes_arg(p)
     add_overwrite_arg(p)
     add_verbose_arg(p)
 
     return p
 
 
+class _BidsIgnore(object):
+    """Matcher for the rules of a .bidsignore file, used as an ignore pattern
+    by pybids, which only calls its search method.
+
+    pybids searches the patterns anywhere in the path, so a rule without
+    wildcard is matched with str.endswith and a literal rule surrounded by
+    '*' with a substring test. Only the remaining globs go through a regex.
+
+    Parameters
+    ----------
+    rules : list of str
+        Glob patterns read from .bidsignore files.
+    """
+    def __init__(self, rules):
+        suffixes = []
+        substrings = []
+        globs = []
+        for rule in rules:
+            core = rule[1:] if rule.startswith('*') else rule
+            if not any(c in core for c in '*?['):
+                # No wildcard, or a leading one only: 'literal' or '*literal'
+                suffixes.append(core)
+            elif core.endswith('*') and \
+                    not any(c in core[:-1] for c in '*?[') and core[:-1]:
+                # 'literal*' or '*literal*'
+                substrings.append(core[:-1])
+            else:
+                globs.append(rule)
+
+        self.suffixes = tuple(suffixes)
+        self.substrings = tuple(substrings)
+        self.regex = None
+        if globs:
+            # fnmatch patterns only need ASCII semantics
+            self.regex = re.compile("|".join(
+                "(?:{})".format(fnmatch.translate(g)) for g in globs),
+                re.DOTALL | re.ASCII)
+
+    def search(self, path):
+        if path.endswith(self.suffixes):
+            return True
+        if any(s in path for s in self.substrings):
+            return True
+        return self.regex is not None and self.regex.search(path) is not None
+
+
 def _load_bidsignore_(bids_root, additional_bidsignore=None):
-    """Load .bidsignore file from a BIDS dataset, returns list of regexps"""
+    """Load .bidsignore file from a BIDS dataset, returns a list containing
+    a single matcher for all the ignored patterns"""
     bids_root = pathlib.Path(bids_root)
     bids_ignore_path = bids_root / ".bidsignore"
     bids_ignores = []
@@ -92,19 +162,36 @@ def _load_bidsignore_(bids_root, additional_bidsignore=None):
         bids_ignores = bids_ignores + \
             pathlib.Path(os.path.abspath(additional_bidsignore)).read_text().splitlines()
 
+    # Drop empty lines and comments
+    bids_ignores = [bi for bi in bids_ignores
+                    if bi.strip() and bi.strip()[0] != "#"]
+
+    # pybids iterates over the ignore patterns, the matcher must be in a list
     if bids_ignores:
-        import re
-        import fnmatch
-        return tuple(
-            [
-                re.compile(fnmatch.translate(bi))
-                for bi in bids_ignores
-                if len(bi) and bi.strip()[0] != "#"
-            ]
-        )
-    return tuple()
+        return [_BidsIgnore(bids_ignores)]
+    return []
+
+
+def _get_participants_ignore(participants):
+    """ Return a regexp ignoring the folders of all the participants
+    except the selected ones
 
+    Parameters
+    ----------
+    participants: list of String
+        Participant labels to keep, with or without the 'sub-' prefix
 
+    Returns
+    -------
+        Compiled regexp, matched by pybids on paths relative to the dataset
+        root (e.g. /sub-01/dwi)
+    """
+    labels = [re.escape(re.sub('^sub-', '', curr_participant))
+              for curr_participant in participants]
+    return re.compile(r'^/sub-(?!(?:{})(?:/|$))[^/]+'.format('|'.join(labels)))
+
+
+@functools.lru_cache(maxsize=None)
 def get_opposite_phase_encoding_direction(phase_encoding_direction):
     """ Return opposite direction (works with direction or PhaseEncodingDirection)
 
@@ -125,7 +212,53 @@ def get_opposite_phase_encoding_direction(phase_encoding_direction):
         return phase_encoding_direction+'-'
 
 
-def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
+def _probe_mri(subject_dir):
+    """ Return the Freesurfer files of a subject
+
+    Parameters
+    ----------
+    subject_dir: String
+        Freesurfer folder of the subject
+
+    Returns
+    -------
+        List of T1, wmparc and aparc+aseg paths or None if one is missing
+    """
+    mri_dir = pathlib.Path(subject_dir) / 'mri'
+    fs_files = [mri_dir / curr_file
+                for curr_file in ['T1.mgz', 'wmparc.mgz', 'aparc+aseg.mgz']]
+    if all(curr_file.is_file() for curr_file in fs_files):
+        return [str(curr_file) for curr_file in fs_files]
+    return None
+
+
+def _get_fs_index(fs_dir):
+    """ Scan the Freesurfer folder once and index the files of each subject
+
+    Parameters
+    ----------
+    fs_dir: String
+        Freesurfer folder
+
+    Returns
+    -------
+        Dict of subject id to the list of Freesurfer files (or None). Empty
+        if the folder does not exist.
+    """
+    fs_index = {}
+    if not os.path.isdir(fs_dir):
+        logging.warning('Freesurfer folder {} not found.'.format(fs_dir))
+        return fs_index
+
+    with os.scandir(fs_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('sub-') and entry.is_dir():
+                fs_index[entry.name[4:]] = _probe_mri(entry.path)
+    return fs_index
+
+
+def get_data(layout, intended_map, nSub, dwis, t1s, fs, default_readout,
+             clean):
     """ Return subject data
 
     Parameters
@@ -133,6 +266,9 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
     layout: BIDS layout
         Current BIDS layout
 
+    intended_map: dict
+        Files pointing to each path with IntendedFor (see _get_intended_map)
+
     nSub : String
         Subject name
 
@@ -167,64 +303,55 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
     nRun = 0
 
     if len(dwis) == 2:
+        # Read the entities proxy of the file once
+        rev_dwi_entities = dict(dwis[1].entities)
         dwi_path[1] = dwis[1].path
         bvec_path[1] = layout.get_bvec(dwis[1].path)
         bval_path[1] = layout.get_bval(dwis[1].path)
-        if 'direction' in dwis[1].entities:
-            PE[1] = conversion[dwis[1].entities['direction']]
-        elif 'PhaseEncodingDirection' in dwis[1].entities:
-            PE[1] = conversion[dwis[1].entities['PhaseEncodingDirection']]
+        rev_direction_key = _get_direction_key(rev_dwi_entities)
+        if rev_direction_key:
+            PE[1] = conversion[rev_dwi_entities[rev_direction_key]]
 
     curr_dwi = dwis[0]
+    dwi_entities = dict(curr_dwi.entities)
     dwi_path[0] = curr_dwi.path
     bvec_path[0] = layout.get_bvec(curr_dwi.path)
     bval_path[0] = layout.get_bval(curr_dwi.path)
 
-    if 'TotalReadoutTime' in curr_dwi.entities:
-        totalreadout = curr_dwi.entities['TotalReadoutTime']
+    if 'TotalReadoutTime' in dwi_entities:
+        totalreadout = dwi_entities['TotalReadoutTime']
 
-    if 'session' in curr_dwi.entities:
-        nSess = curr_dwi.entities['session']
+    if 'session' in dwi_entities:
+        nSess = dwi_entities['session']
 
-    if 'run' in curr_dwi.entities:
-        nRun = curr_dwi.entities['run']
+    if 'run' in dwi_entities:
+        nRun = dwi_entities['run']
 
     IntendedForPath = os.path.sep.join(curr_dwi.relpath.split(os.path.sep)[1:])
-    related_files = layout.get(part="mag",
-                               IntendedFor=IntendedForPath,
-                               regex_search=True,
-                               TotalReadoutTime=totalreadout,
-                               invalid_filters='drop') +\
-        layout.get(part=Query.NONE,
-                   IntendedFor=IntendedForPath,
-                   regex_search=True,
-                   TotalReadoutTime=totalreadout,
-                   invalid_filters='drop')
-    related_files_filtered = []
-    for curr_related in related_files:
-        if curr_related.entities['suffix'] != 'dwi' and\
-           curr_related.entities['extension'] == '.nii.gz':
-            related_files_filtered.append(curr_related)
-
-    related_files = related_files_filtered
-    direction_key = False
-    if 'direction' in curr_dwi.entities:
-        direction_key = 'direction'
-    elif 'PhaseEncodingDirection' in curr_dwi.entities:
-        direction_key = 'PhaseEncodingDirection'
-
-    dwi_direction = curr_dwi.entities[direction_key]
+    # TotalReadoutTime is only filtered if the layout knows this entity
+    check_readout = 'TotalReadoutTime' in _get_layout_entities(layout)
+    related_files = [curr_related
+                     for curr_related in intended_map.get(IntendedForPath, [])
+                     if not check_readout or
+                     curr_related.entities.get('TotalReadoutTime') ==
+                     totalreadout]
+    direction_key = _get_direction_key(dwi_entities)
+
+    dwi_direction = dwi_entities[direction_key]
     PE[0] = conversion[dwi_direction]
 
     if related_files and direction_key:
         related_files_suffixes = []
         for curr_related in related_files:
-            related_files_suffixes.append(curr_related.entities['suffix'])
-            if dwi_direction == get_opposite_phase_encoding_direction(curr_related.entities[direction_key]):
-                PE[1] = conversion[curr_related.entities[direction_key]]
-                topup_suffix[curr_related.entities['suffix']][1] = curr_related.path
+            related_entities = curr_related.entities
+            related_suffix = related_entities['suffix']
+            related_direction = related_entities[direction_key]
+            related_files_suffixes.append(related_suffix)
+            if dwi_direction == get_opposite_phase_encoding_direction(related_direction):
+                PE[1] = conversion[related_direction]
+                topup_suffix[related_suffix][1] = curr_related.path
             else:
-                topup_suffix[curr_related.entities['suffix']][0] = curr_related.path
+                topup_suffix[related_suffix][0] = curr_related.path
 
         if related_files_suffixes.count('epi') > 2 or related_files_suffixes.count('sbref') > 2:
             topup_suffix = {'epi': ['', ''], 'sbref': ['', '']}
@@ -233,19 +360,21 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
         topup = ['', '']
         logging.warning('IntendedFor: No file pointing to {}'.format(dwis[0].path))
 
+    sbref = topup_suffix['sbref']
+    epi = topup_suffix['epi']
     if len(dwis) == 2:
-        if not any(s == '' for s in topup_suffix['sbref']):
-            topup = topup_suffix['sbref']
-        elif not any(s == '' for s in topup_suffix['epi']):
-            topup = topup_suffix['epi']
+        if sbref[0] and sbref[1]:
+            topup = sbref
+        elif epi[0] and epi[1]:
+            topup = epi
         else:
             topup = ['', '']
     elif len(dwis) == 1:
         # If one DWI you cannot have a reverse sbref
         # since sbref is a derivate of multi-band dwi
-        if topup_suffix['epi'][1] != '':
-            topup = topup_suffix['epi']
-        elif not any(s == '' for s in topup_suffix['sbref']):
+        if epi[1]:
+            topup = epi
+        elif sbref[0] and sbref[1]:
             logging.warning("You have two sbref but only one dwi this scheme is not accepted.")
             topup = ['', '']
         else:
@@ -258,7 +387,7 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
                         """)
         return {}
 
-    if not any(s == '' for s in topup):
+    if topup[0] and topup[1]:
         logging.info("Found rev b0 and b0 images to correct for geometrical distorsion")
     elif not topup[1]:
         logging.warning("No rev image found to correct for geometrical distorsion")
@@ -281,8 +410,9 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
             return {}
 
         for t1 in t1s:
-            if 'session' in t1.entities:
-                if t1.entities['session'] == nSess:
+            t1_entities = t1.entities
+            if 'session' in t1_entities:
+                if t1_entities['session'] == nSess:
                     t1_nSess.append(t1)
             else:
                 t1_nSess.append(t1)
@@ -315,6 +445,175 @@ def get_data(layout, nSub, dwis, t1s, fs, default_readout, clean):
             'TotalReadoutTime': totalreadout}
 
 
+def _match_entity(entities, name, value):
+    """ Check an entity the same way pybids filters it in layout.get
+
+    Parameters
+    ----------
+    entities: dict
+        Entities of a BIDSFile
+    name: String
+        Entity name
+    value: String or Query.ANY
+        Expected value. Query.ANY only requires the entity to be defined.
+
+    Returns
+    -------
+        True if the entity matches
+    """
+    if value == Query.ANY:
+        return name in entities
+    return entities.get(name) == value
+
+
+def _get_intended_map(layout, nSub):
+    """ Index the files of a subject by the paths of their IntendedFor
+
+    Only nifti files, other than dwis, with no part or a magnitude part
+    are kept. Magnitude files come first.
+
+    Parameters
+    ----------
+    layout: pyBIDS layout
+        BIDS layout
+    nSub: String
+        Current subject
+
+    Returns
+    -------
+        Dict of path, relative to the subject folder, to the list of
+        BIDSFile pointing to it
+    """
+    nii_files = [curr_file
+                 for curr_file in layout.get(subject=nSub, extension='nii.gz')
+                 if curr_file.entities.get('suffix') != 'dwi']
+    nii_files = [curr_file for curr_file in nii_files
+                 if curr_file.entities.get('part') == 'mag'] +\
+        [curr_file for curr_file in nii_files
+         if 'part' not in curr_file.entities]
+
+    intended_map = defaultdict(list)
+    for curr_file in nii_files:
+        intended_for = curr_file.entities.get('IntendedFor') or []
+        if isinstance(intended_for, str):
+            intended_for = [intended_for]
+
+        for curr_target in intended_for:
+            # Paths are relative to the subject folder, BIDS URIs
+            # also contain it
+            curr_target = re.sub('^bids::', '', curr_target)
+            if curr_target.startswith('sub-'):
+                curr_target = curr_target.split('/', 1)[-1]
+            intended_map[curr_target].append(curr_file)
+
+    return intended_map
+
+
+@functools.lru_cache(maxsize=1)
+def _get_layout_entities(layout):
+    """ Return the names of the entities of a layout, queried once per layout
+
+    Parameters
+    ----------
+    layout: pyBIDS layout
+        BIDS layout
+
+    Returns
+    -------
+        frozenset of entity names
+    """
+    return frozenset(layout.get_entities())
+
+
+def _get_direction_key(entities):
+    """ Return the entity used for the phase encoding direction
+
+    Parameters
+    ----------
+    entities: dict
+        Entities of a BIDSFile
+
+    Returns
+    -------
+        'direction', 'PhaseEncodingDirection' or False if neither is defined
+    """
+    if 'direction' in entities:
+        return 'direction'
+    elif 'PhaseEncodingDirection' in entities:
+        return 'PhaseEncodingDirection'
+    return False
+
+
+def _get_file_entities(bids_file):
+    """ Return the filename entities and all the entities of a file
+
+    Both are read from the tags already loaded with the file, instead of
+    querying the database with get_entities.
+
+    Parameters
+    ----------
+    bids_file: BIDSFile object
+        Current file
+
+    Returns
+    -------
+    filename_entities: dict
+        Entities defined by the filename
+    entities: dict
+        Entities defined by the filename and the metadata
+    """
+    filename_entities = {}
+    entities = {}
+    for name, tag in bids_file.tags.items():
+        entities[name] = tag.value
+        if not tag.is_metadata:
+            filename_entities[name] = tag.value
+    return filename_entities, entities
+
+
+def _get_entity_values(files_entities, name):
+    """ Return the unique values of an entity, like layout.get_<entity>
+
+    Parameters
+    ----------
+    files_entities: dict
+        Entities of each file (see _get_file_entities)
+    name: String
+        Entity name
+
+    Returns
+    -------
+        Sorted list of values
+    """
+    return sorted({entities[name] for _, entities in files_entities.values()
+                   if name in entities})
+
+
+def _get_entities_key(filename_entities, entities,
+                      phase_encoding_direction=None):
+    """ Return a hashable key of the filename entities of a file, including
+    its phase encoding direction
+
+    Parameters
+    ----------
+    filename_entities: dict
+        Entities defined by the filename (see _get_file_entities)
+    entities: dict
+        Entities defined by the filename and the metadata
+    phase_encoding_direction: String, optional
+        If set, replaces the phase encoding direction of the file
+
+    Returns
+    -------
+        Sorted tuple of (entity, value) pairs
+    """
+    key = dict(filename_entities)
+    direction = _get_direction_key(entities)
+    if direction:
+        key[direction] = phase_encoding_direction or entities[direction]
+    return tuple(sorted(key.items()))
+
+
 def associate_dwis(layout, nSub):
     """ Return subject data
     Parameters
@@ -335,102 +634,283 @@ def associate_dwis(layout, nSub):
                  'extension': 'nii.gz',
                  'suffix': 'dwi'}
 
+    # Query the DWIs of the subject once and filter them locally afterwards
+    all_files = layout.get(**base_dict)
+
+    # Read the entities of each file once
+    dwi_entities = {curr_file.path: _get_file_entities(curr_file)
+                    for curr_file in all_files}
+
+    # DWIs without part first, then magnitude DWIs
+    dwi_files = [curr_file for curr_file in all_files
+                 if 'part' not in dwi_entities[curr_file.path][1]] +\
+        [curr_file for curr_file in all_files
+         if dwi_entities[curr_file.path][1].get('part') == 'mag']
+
     # Get possible directions
     phaseEncodingDirection = [Query.ANY, Query.ANY]
-    directions = layout.get_direction(**base_dict)
-
-    directions.sort()
+    directions = _get_entity_values(dwi_entities, 'direction')
 
-    if not directions and 'PhaseEncodingDirection' in layout.get_entities():
+    if not directions and \
+            'PhaseEncodingDirection' in _get_layout_entities(layout):
         logging.info("Found no directions.")
         directions = [Query.ANY, Query.ANY]
-        phaseEncodingDirection = layout.get_PhaseEncodingDirection(**base_dict)
+        phaseEncodingDirection = _get_entity_values(dwi_entities,
+                                                    'PhaseEncodingDirection')
         if len(phaseEncodingDirection) == 1:
             logging.info("Found one phaseEncodingDirection.")
-            return [[el] for el in layout.get(part=Query.NONE, **base_dict) +
-                    layout.get(part='mag', **base_dict)]
+            return [[el] for el in dwi_files]
     elif len(directions) == 1:
         logging.info("Found one direction.")
-        return [[el] for el in layout.get(part=Query.NONE, **base_dict) +
-                layout.get(part='mag', **base_dict)]
+        return [[el] for el in dwi_files]
     elif not directions:
         logging.info("Found no directions or PhaseEncodingDirections.")
-        return [[el] for el in layout.get(part=Query.NONE, **base_dict) +
-                layout.get(part='mag', **base_dict)]
+        return [[el] for el in dwi_files]
 
     if len(phaseEncodingDirection) > 2 or len(directions) > 2:
         logging.warning("These acquisitions have too many encoding directions.")
         return []
 
-    all_dwis = layout.get(part=Query.NONE,
-                          PhaseEncodingDirection=phaseEncodingDirection[0],
-                          direction=directions[0],
-                          **base_dict) +\
-        layout.get(part='mag',
-                   PhaseEncodingDirection=phaseEncodingDirection[0],
-                   direction=directions[0],
-                   **base_dict)
-
-    all_rev_dwis = layout.get(part=Query.NONE,
-                              PhaseEncodingDirection=phaseEncodingDirection[1],
-                              direction=directions[1],
-                              **base_dict) +\
-        layout.get(part='mag',
-                   PhaseEncodingDirection=phaseEncodingDirection[1],
-                   direction=directions[1],
-                   **base_dict)
+    all_dwis = [curr_dwi for curr_dwi in dwi_files
+                if _match_entity(dwi_entities[curr_dwi.path][1],
+                                 'PhaseEncodingDirection',
+                                 phaseEncodingDirection[0]) and
+                _match_entity(dwi_entities[curr_dwi.path][1], 'direction',
+                              directions[0])]
+
+    all_rev_dwis = [curr_dwi for curr_dwi in dwi_files
+                    if _match_entity(dwi_entities[curr_dwi.path][1],
+                                     'PhaseEncodingDirection',
+                                     phaseEncodingDirection[1]) and
+                    _match_entity(dwi_entities[curr_dwi.path][1], 'direction',
+                                  directions[1])]
 
     all_associated_dwis = []
     logging.info('Number of dwi: {}'.format(len(all_dwis)))
     logging.info('Number of rev_dwi: {}'.format(len(all_rev_dwis)))
-    while len(all_dwis) > 0:
-        curr_dwi = all_dwis[0]
 
-        curr_association = [curr_dwi]
+    # Index rev_dwis by their entities so each dwi finds its partners
+    # with a single lookup
+    rev_dwis_by_entities = defaultdict(list)
+    for rev_dwi in all_rev_dwis:
+        rev_key = _get_entities_key(*dwi_entities[rev_dwi.path])
+        rev_dwis_by_entities[rev_key].append(rev_dwi)
 
-        # Fake reverse so it can be used to compare with real rev
-        rev_curr_entity = curr_dwi.get_entities()
-
-        rev_iter_to_rm = []
-        for iter_rev, rev_dwi in enumerate(all_rev_dwis):
-            # At this stage, we need to check only direction
-            direction = False
-            if 'direction' in curr_dwi.entities:
-                direction = 'direction'
-            elif 'PhaseEncodingDirection' in curr_dwi.entities:
-                direction = 'PhaseEncodingDirection'
-
-            if direction:
-                rev_curr_entity[direction] = get_opposite_phase_encoding_direction(rev_curr_entity[direction])
-                if rev_curr_entity == rev_dwi.get_entities():
+    used_rev_dwis = set()
+    for curr_dwi in all_dwis:
+        curr_association = [curr_dwi]
+        logging.info('Checking dwi {}'.format(curr_dwi))
+
+        # At this stage, we need to check only direction
+        filename_entities, entities = dwi_entities[curr_dwi.path]
+        direction = _get_direction_key(entities)
+        if direction:
+            # Fake reverse so it can be used to compare with real rev
+            rev_direction = get_opposite_phase_encoding_direction(
+                entities[direction])
+            rev_key = _get_entities_key(filename_entities, entities,
+                                        rev_direction)
+
+            if rev_key in rev_dwis_by_entities:
+                for rev_dwi in rev_dwis_by_entities.pop(rev_key):
+                    logging.info('Found rev_dwi {}'.format(rev_dwi))
                     curr_association.append(rev_dwi)
-                    rev_iter_to_rm.append(iter_rev)
-                else:
-                    if rev_curr_entity[direction] == rev_dwi.entities[direction]:
-                        # Print difference between entities
-                        logging.warning('DWIs {} and {} have opposite phase encoding directions but different entities.'
-                                     'Please check their respective json files.'.format(curr_dwi, rev_dwi))
-
-        # drop all rev_dwi used
-        logging.info('Checking dwi {}'.format(all_dwis[0]))
-        for item_to_remove in rev_iter_to_rm[::-1]:
-            logging.info('Found rev_dwi {}'.format(all_rev_dwis[item_to_remove]))
-            del all_rev_dwis[item_to_remove]
+                    used_rev_dwis.add(rev_dwi.path)
+            else:
+                for rev_dwis in rev_dwis_by_entities.values():
+                    for rev_dwi in rev_dwis:
+                        rev_entities = dwi_entities[rev_dwi.path][1]
+                        if rev_direction == rev_entities.get(direction):
+                            # Print difference between entities
+                            logging.warning('DWIs {} and {} have opposite phase encoding directions but different entities.'
+                                            'Please check their respective json files.'.format(curr_dwi, rev_dwi))
 
         # Add to associated list
         if len(curr_association) < 3:
             all_associated_dwis.append(curr_association)
         else:
             logging.warning("These acquisitions have too many associated dwis.")
-        del all_dwis[0]
 
-    if len(all_rev_dwis):
-        for curr_rev_dwi in all_rev_dwis:
+    for curr_rev_dwi in all_rev_dwis:
+        if curr_rev_dwi.path not in used_rev_dwis:
             all_associated_dwis.append([curr_rev_dwi])
 
     return all_associated_dwis
 
 
+def _process_subject(layout, nSub, fs_inputs, use_fs, default_readout,
+                     clean):
+    """ Return the data of every DWI run of a subject
+
+    Parameters
+    ----------
+    layout: pyBIDS layout
+        BIDS layout
+    nSub: String
+        Current subject to analyse
+    fs_inputs: list or None
+        Freesurfer files of the subject (see _get_fs_index)
+    use_fs: String
+        Freesurfer folder. If None, T1s are looked for in the layout.
+    default_readout: Float
+        Default readout time
+    clean: Boolean
+        If set, runs missing critical files are empty
+
+    Returns
+    -------
+        List of dictionnaries containing the metadata
+    """
+    mess = 'Validating subject: {}'.format(nSub)
+    logging.info("-" * len(mess))
+    logging.info(mess)
+    dwis = associate_dwis(layout, nSub)
+    intended_map = _get_intended_map(layout, nSub)
+    t1s = []
+
+    if use_fs:
+        logging.info("Looking for FS files")
+        fs_inputs = fs_inputs or []
+        if fs_inputs:
+            logging.info("Found FS files")
+    else:
+        fs_inputs = []
+        logging.info("Looking for T1 files")
+        t1s = layout.get(subject=nSub,
+                         datatype='anat', extension='nii.gz',
+                         suffix='T1w')
+        if t1s:
+            logging.info("Found {} T1 files".format(len(t1s)))
+
+    # Get the data for each run of DWIs
+    return [get_data(layout, intended_map, nSub, dwi, t1s, fs_inputs,
+                     default_readout, clean)
+            for dwi in dwis]
+
+
+def _process_subject_wrapper(args):
+    layout = BIDSLayout.load(args[0])
+    return _process_subject(layout, *args[1:])
+
+
+def _dump_rows(rows, outfile, clean):
+    """ Write the rows as a json list, one row at a time
+
+    The output is the same as json.dump of the whole list with an indent of
+    4 and sorted keys, without keeping all the rows in memory.
+
+    Parameters
+    ----------
+    rows: iterable of dict
+        Data of each DWI run
+    outfile: file object
+        Output json file
+    clean: Boolean
+        If set, empty rows are skipped
+    """
+    separator = '[\n'
+    for row in rows:
+        if clean and not row:
+            continue
+
+        outfile.write(separator)
+        outfile.write(textwrap.indent(json.dumps(row,
+                                                 indent=4,
+                                                 separators=(',', ': '),
+                                                 sort_keys=True),
+                                      ' ' * 4))
+        separator = ',\n'
+
+    # Add trailing newline for POSIX compatibility
+    if separator == '[\n':
+        outfile.write('[]\n')
+    else:
+        outfile.write('\n]\n')
+
+
+def _write_json(out_json, results, clean):
+    """ Write the rows of every subject to the output json
+
+    The rows are written to a temporary file next to the output, which only
+    replaces it once every subject is done. If a subject fails, the
+    temporary file is removed and a previous output is kept.
+
+    Parameters
+    ----------
+    out_json: String
+        Output json file
+    results: iterable of list of dict
+        Rows of each subject (see _process_subject)
+    clean: Boolean
+        If set, empty rows are skipped
+    """
+    tmp_json = '{}.{}.tmp'.format(out_json, os.getpid())
+    try:
+        with open(tmp_json, 'w') as outfile:
+            _dump_rows(itertools.chain.from_iterable(results), outfile,
+                       clean)
+        os.replace(tmp_json, out_json)
+    except BaseException:
+        if os.path.exists(tmp_json):
+            os.remove(tmp_json)
+        raise
+
+
+def _validate_bids(args, ignore, database_path, nbr_cpu):
+    """ Index the BIDS dataset and write the data of its subjects
+
+    Parameters
+    ----------
+    args: argparse namespace
+        Args of the script
+    ignore: list
+        Ignore patterns for the indexer
+    database_path: String
+        Database of the layout. Required to use more than one process.
+    nbr_cpu: int
+        Number of processes
+    """
+    bids_indexer = BIDSLayoutIndexer(validate=False, ignore=ignore)
+    layout = BIDSLayout(os.path.abspath(args.in_bids), indexer=bids_indexer,
+                        database_path=database_path)
+
+    subjects = layout.get_subjects()
+    subjects.sort()
+
+    if args.participants:
+        # A layout loaded from --layout_db was indexed without the
+        # participants ignore, so its subjects are filtered here too
+        participants = set(re.sub('^sub-', '', curr_participant)
+                           for curr_participant in args.participants)
+        missing = participants - set(subjects)
+        if missing:
+            logging.warning('Participant(s) not found: {}'.format(
+                ', '.join(sorted(missing))))
+        subjects = [nSub for nSub in subjects if nSub in participants]
+
+    logging.info("Found {} subject(s)".format(len(subjects)))
+
+    fs_index = {}
+    if args.fs:
+        fs_index = _get_fs_index(os.path.abspath(args.fs))
+
+    if nbr_cpu == 1:
+        results = (_process_subject(layout, nSub, fs_index.get(nSub),
+                                    args.fs, args.readout, args.clean)
+                   for nSub in subjects)
+        _write_json(args.out_json, results, args.clean)
+    else:
+        with multiprocessing.Pool(nbr_cpu) as pool:
+            results = pool.imap(_process_subject_wrapper,
+                                zip(itertools.repeat(database_path),
+                                    subjects,
+                                    [fs_index.get(nSub) for nSub in subjects],
+                                    itertools.repeat(args.fs),
+                                    itertools.repeat(args.readout),
+                                    itertools.repeat(args.clean)))
+            _write_json(args.out_json, results, args.clean)
+
+
 def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
@@ -442,63 +922,24 @@ def main():
         logging.getLogger().setLevel(logging.INFO)
     coloredlogs.install(level=logging.INFO)
 
-    data = []
-    bids_indexer = BIDSLayoutIndexer(validate=False,
-                                     ignore=_load_bidsignore_(os.path.abspath(args.in_bids),
-                                                              args.bids_ignore))
-    layout = BIDSLayout(os.path.abspath(args.in_bids), indexer=bids_indexer)
-
-    subjects = layout.get_subjects()
-    subjects.sort()
-
-    logging.info("Found {} subject(s)".format(len(subjects)))
-
-    for nSub in subjects:
-        mess = 'Validating subject: {}'.format(nSub)
-        logging.info("-" * len(mess))
-        logging.info(mess)
-        dwis = associate_dwis(layout, nSub)
-        fs_inputs = []
-        t1s = []
-
-        if args.fs:
-            abs_fs = os.path.abspath(args.fs)
-            logging.info("Looking for FS files")
-            t1_fs = glob(os.path.join(abs_fs, 'sub-' + nSub, 'mri/T1.mgz'))
-            wmparc = glob(os.path.join(abs_fs, 'sub-' + nSub, 'mri/wmparc.mgz'))
-            aparc_aseg = glob(os.path.join(abs_fs, 'sub-' + nSub,
-                                           'mri/aparc+aseg.mgz'))
-            if len(t1_fs) == 1 and len(wmparc) == 1 and len(aparc_aseg) == 1:
-                fs_inputs = [t1_fs[0], wmparc[0], aparc_aseg[0]]
-                logging.info("Found FS files")
-        else:
-            logging.info("Looking for T1 files")
-            t1s = layout.get(subject=nSub,
-                             datatype='anat', extension='nii.gz',
-                             suffix='T1w')
-            if t1s:
-                logging.info("Found {} T1 files".format(len(t1s)))
-        # Get the data for each run of DWIs
-        for dwi in dwis:
-            data.append(get_data(layout,
-                                 nSub,
-                                 dwi,
-                                 t1s,
-                                 fs_inputs,
-                                 args.readout,
-                                 args.clean))
-
-    if args.clean:
-        data = [d for d in data if d]
-
-    with open(args.out_json, 'w') as outfile:
-        json.dump(data,
-                  outfile,
-                  indent=4,
-                  separators=(',', ': '),
-                  sort_keys=True)
-        # Add trailing newline for POSIX compatibility
-        outfile.write('\n')
+    ignore = _load_bidsignore_(os.path.abspath(args.in_bids),
+                               args.bids_ignore)
+    if args.participants:
+        ignore.append(_get_participants_ignore(args.participants))
+
+    # Sub-processes reload the layout from its database
+    nbr_cpu = validate_nbr_processes(parser, args)
+    database_path = args.layout_db
+    tmp_dir = None
+    if nbr_cpu > 1 and database_path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        database_path = tmp_dir.name
+
+    try:
+        _validate_bids(args, ignore, database_path, nbr_cpu)
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
 
 
 if __name__ == '__main__':
@@ -2,342 +2,62 @@
 # -*- coding: utf-8 -*-
 
 import os
+import pytest
 import tempfile
 
 from scilpy.io.fetcher import fetch_data, get_home, get_testing_files_dict
 
-# If they already exist, this only takes 5 seconds (check md5sum)
-fetch_data(get_testing_files_dict(), keys=['ihMT.zip'])
-tmp_dir = tempfile.TemporaryDirectory()
 
-
-def test_help_option(script_runner):
-    ret = script_runner.run('scil_compute_ihMT_maps.py', '--help')
-    assert ret.success
+@pytest.fixture(scope='session', autouse=True)
+def fetch_test_data():
+    # If they already exist, this only takes 5 seconds (check md5sum)
+    fetch_data(get_testing_files_dict(), keys=['ihMT.zip'])
 
 
-def test_execution_ihMT_no_option(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
+@pytest.fixture(scope='session')
+def tmp_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yield tmp_dir
 
-    in_mask = os.path.join(get_home(), 'ihMT', 'mask_resample.nii.gz')
 
-    in_e1_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altnp_ihmt.nii.gz')
-    in_e2_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altnp_ihmt.nii.gz')
-    in_e3_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altnp_ihmt.nii.gz')
+def _get_ihMT_file(name):
+    return os.path.join(get_home(), 'ihMT', name)
 
-    in_e1_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altpn_ihmt.nii.gz')
-    in_e2_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altpn_ihmt.nii.gz')
-    in_e3_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altpn_ihmt.nii.gz')
 
-    in_e1_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-mtoff_ihmt.nii.gz')
-    in_e2_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-mtoff_ihmt.nii.gz')
-    in_e3_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-mtoff_ihmt.nii.gz')
+in_mask = _get_ihMT_file('mask_resample.nii.gz')
+in_b1_map = _get_ihMT_file('B1map.nii.gz')
 
-    in_e1_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-neg_ihmt.nii.gz')
-    in_e2_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-neg_ihmt.nii.gz')
-    in_e3_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-neg_ihmt.nii.gz')
+# Contrasts of the three echoes, shared by all the executions
+in_echoes = []
+for option, acq in [('--in_altnp', 'altnp'), ('--in_altpn', 'altpn'),
+                    ('--in_mtoff', 'mtoff'), ('--in_negative', 'neg'),
+                    ('--in_positive', 'pos'), ('--in_t1w', 'T1w')]:
+    in_echoes.append(option)
+    for echo in range(1, 4):
+        in_echoes.append(_get_ihMT_file(
+            'echo-{}_acq-{}_ihmt.nii.gz'.format(echo, acq)))
 
-    in_e1_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-pos_ihmt.nii.gz')
-    in_e2_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-pos_ihmt.nii.gz')
-    in_e3_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-pos_ihmt.nii.gz')
 
-    in_e1_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-T1w_ihmt.nii.gz')
-    in_e2_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-T1w_ihmt.nii.gz')
-    in_e3_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-T1w_ihmt.nii.gz')
-
-    # no option
-    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir.name,
-                            in_mask,
-                            '--in_altnp', in_e1_altnp, in_e2_altnp,
-                            in_e3_altnp,
-                            '--in_altpn', in_e1_altpn, in_e2_altpn,
-                            in_e3_altpn,
-                            '--in_mtoff', in_e1_mtoff, in_e2_mtoff,
-                            in_e3_mtoff,
-                            '--in_negative', in_e1_neg, in_e2_neg, in_e3_neg,
-                            '--in_positive', in_e1_pos, in_e2_pos, in_e3_pos,
-                            '--in_t1w', in_e1_t1w, in_e2_t1w, in_e3_t1w,
-                            '-f')
+def test_help_option(script_runner):
+    ret = script_runner.run('scil_compute_ihMT_maps.py', '--help')
     assert ret.success
 
 
-def test_execution_ihMT_prefix(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
-
-    in_mask = os.path.join(get_home(), 'ihMT', 'mask_resample.nii.gz')
-
-    in_e1_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altnp_ihmt.nii.gz')
-    in_e2_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altnp_ihmt.nii.gz')
-    in_e3_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altnp_ihmt.nii.gz')
-
-    in_e1_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altpn_ihmt.nii.gz')
-    in_e2_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altpn_ihmt.nii.gz')
-    in_e3_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altpn_ihmt.nii.gz')
-
-    in_e1_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-mtoff_ihmt.nii.gz')
-    in_e2_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-mtoff_ihmt.nii.gz')
-    in_e3_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-mtoff_ihmt.nii.gz')
-
-    in_e1_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-neg_ihmt.nii.gz')
-    in_e2_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-neg_ihmt.nii.gz')
-    in_e3_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-neg_ihmt.nii.gz')
-
-    in_e1_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-pos_ihmt.nii.gz')
-    in_e2_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-pos_ihmt.nii.gz')
-    in_e3_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-pos_ihmt.nii.gz')
-
-    in_e1_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-T1w_ihmt.nii.gz')
-    in_e2_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-T1w_ihmt.nii.gz')
-    in_e3_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-T1w_ihmt.nii.gz')
-
+@pytest.mark.parametrize("extra_args", [
+    # no option
+    [],
     # --out_prefix
-    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir.name,
-                            in_mask,
-                            '--in_altnp', in_e1_altnp, in_e2_altnp,
-                            in_e3_altnp,
-                            '--in_altpn', in_e1_altpn, in_e2_altpn,
-                            in_e3_altpn,
-                            '--in_mtoff', in_e1_mtoff, in_e2_mtoff,
-                            in_e3_mtoff,
-                            '--in_negative', in_e1_neg, in_e2_neg,
-                            in_e3_neg,
-                            '--in_positive', in_e1_pos, in_e2_pos,
-                            in_e3_pos,
-                            '--in_t1w', in_e1_t1w, in_e2_t1w, in_e3_t1w,
-                            '--out_prefix', 'sub_01',
-                            '-f')
-    assert ret.success
-
-
-def test_execution_ihMT_filtering(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
-
-    in_mask = os.path.join(get_home(), 'ihMT', 'mask_resample.nii.gz')
-
-    in_e1_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altnp_ihmt.nii.gz')
-    in_e2_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altnp_ihmt.nii.gz')
-    in_e3_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altnp_ihmt.nii.gz')
-
-    in_e1_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altpn_ihmt.nii.gz')
-    in_e2_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altpn_ihmt.nii.gz')
-    in_e3_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altpn_ihmt.nii.gz')
-
-    in_e1_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-mtoff_ihmt.nii.gz')
-    in_e2_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-mtoff_ihmt.nii.gz')
-    in_e3_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-mtoff_ihmt.nii.gz')
-
-    in_e1_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-neg_ihmt.nii.gz')
-    in_e2_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-neg_ihmt.nii.gz')
-    in_e3_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-neg_ihmt.nii.gz')
-
-    in_e1_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-pos_ihmt.nii.gz')
-    in_e2_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-pos_ihmt.nii.gz')
-    in_e3_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-pos_ihmt.nii.gz')
-
-    in_e1_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-T1w_ihmt.nii.gz')
-    in_e2_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-T1w_ihmt.nii.gz')
-    in_e3_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-T1w_ihmt.nii.gz')
-
-    # --filtering
-    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir.name,
-                            in_mask,
-                            '--in_altnp', in_e1_altnp, in_e2_altnp,
-                            in_e3_altnp,
-                            '--in_altpn', in_e1_altpn, in_e2_altpn,
-                            in_e3_altpn,
-                            '--in_mtoff', in_e1_mtoff, in_e2_mtoff,
-                            in_e3_mtoff,
-                            '--in_negative', in_e1_neg, in_e2_neg, in_e3_neg,
-                            '--in_positive', in_e1_pos, in_e2_pos, in_e3_pos,
-                            '--in_t1w', in_e1_t1w, in_e2_t1w, in_e3_t1w,
-                            '--out_prefix', 'sub-01',
-                            '--filtering',
-                            '-f')
-    assert ret.success
-
-
-def test_execution_ihMT_B1_map(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
-
-    in_mask = os.path.join(get_home(), 'ihMT', 'mask_resample.nii.gz')
-
-    in_e1_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altnp_ihmt.nii.gz')
-    in_e2_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altnp_ihmt.nii.gz')
-    in_e3_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altnp_ihmt.nii.gz')
-
-    in_e1_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altpn_ihmt.nii.gz')
-    in_e2_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altpn_ihmt.nii.gz')
-    in_e3_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altpn_ihmt.nii.gz')
-
-    in_e1_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-mtoff_ihmt.nii.gz')
-    in_e2_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-mtoff_ihmt.nii.gz')
-    in_e3_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-mtoff_ihmt.nii.gz')
-
-    in_e1_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-neg_ihmt.nii.gz')
-    in_e2_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-neg_ihmt.nii.gz')
-    in_e3_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-neg_ihmt.nii.gz')
-
-    in_e1_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-pos_ihmt.nii.gz')
-    in_e2_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-pos_ihmt.nii.gz')
-    in_e3_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-pos_ihmt.nii.gz')
-
-    in_e1_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-T1w_ihmt.nii.gz')
-    in_e2_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-T1w_ihmt.nii.gz')
-    in_e3_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-T1w_ihmt.nii.gz')
-    in_b1_map = os.path.join(get_home(),
-                             'ihMT', 'B1map.nii.gz')
-
+    ['--out_prefix', 'sub_01'],
     # --filtering
-    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir.name,
-                            in_mask,
-                            '--in_altnp', in_e1_altnp, in_e2_altnp,
-                            in_e3_altnp,
-                            '--in_altpn', in_e1_altpn, in_e2_altpn,
-                            in_e3_altpn,
-                            '--in_mtoff', in_e1_mtoff, in_e2_mtoff,
-                            in_e3_mtoff,
-                            '--in_negative', in_e1_neg, in_e2_neg, in_e3_neg,
-                            '--in_positive', in_e1_pos, in_e2_pos, in_e3_pos,
-                            '--in_t1w', in_e1_t1w, in_e2_t1w, in_e3_t1w,
-                            '--out_prefix', 'sub-01',
-                            '--in_B1_map', in_b1_map,
-                            '-f')
-    assert ret.success
-
-
-def test_execution_ihMT_single_echo(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
-
-    in_mask = os.path.join(get_home(), 'ihMT', 'mask_resample.nii.gz')
-
-    in_e1_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altnp_ihmt.nii.gz')
-    in_e2_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altnp_ihmt.nii.gz')
-    in_e3_altnp = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altnp_ihmt.nii.gz')
-
-    in_e1_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-altpn_ihmt.nii.gz')
-    in_e2_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-altpn_ihmt.nii.gz')
-    in_e3_altpn = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-altpn_ihmt.nii.gz')
-
-    in_e1_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-1_acq-mtoff_ihmt.nii.gz')
-    in_e2_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-2_acq-mtoff_ihmt.nii.gz')
-    in_e3_mtoff = os.path.join(get_home(),
-                               'ihMT', 'echo-3_acq-mtoff_ihmt.nii.gz')
-
-    in_e1_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-neg_ihmt.nii.gz')
-    in_e2_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-neg_ihmt.nii.gz')
-    in_e3_neg = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-neg_ihmt.nii.gz')
-
-    in_e1_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-pos_ihmt.nii.gz')
-    in_e2_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-pos_ihmt.nii.gz')
-    in_e3_pos = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-pos_ihmt.nii.gz')
-
-    in_e1_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-1_acq-T1w_ihmt.nii.gz')
-    in_e2_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-2_acq-T1w_ihmt.nii.gz')
-    in_e3_t1w = os.path.join(get_home(),
-                             'ihMT', 'echo-3_acq-T1w_ihmt.nii.gz')
-
-    # --out_prefix
-    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir.name,
-                            in_mask,
-                            '--in_altnp', in_e1_altnp, in_e2_altnp,
-                            in_e3_altnp,
-                            '--in_altpn', in_e1_altpn, in_e2_altpn,
-                            in_e3_altpn,
-                            '--in_mtoff', in_e1_mtoff, in_e2_mtoff,
-                            in_e3_mtoff,
-                            '--in_negative', in_e1_neg, in_e2_neg,
-                            in_e3_neg,
-                            '--in_positive', in_e1_pos, in_e2_pos,
-                            in_e3_pos,
-                            '--in_t1w', in_e1_t1w, in_e2_t1w, in_e3_t1w,
-                            '--out_prefix', 'sub_01',
-                            '--single_echo', '-f')
+    ['--out_prefix', 'sub-01', '--filtering'],
+    # B1 map
+    ['--out_prefix', 'sub-01', '--in_B1_map', in_b1_map],
+    # --single_echo
+    ['--out_prefix', 'sub_01', '--single_echo']],
+    ids=['no_option', 'prefix', 'filtering', 'B1_map', 'single_echo'])
+def test_execution_ihMT(script_runner, tmp_dir, extra_args):
+    os.chdir(os.path.expanduser(tmp_dir))
+
+    ret = script_runner.run('scil_compute_ihMT_maps.py', tmp_dir,
+                            in_mask, *in_echoes, *extra_args, '-f')
     assert ret.success
@@ -2,13 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import os
+import pytest
 import tempfile
 
 from scilpy.io.fetcher import fetch_data, get_home, get_testing_files_dict
 
-# If they already exist, this only takes 5 seconds (check md5sum)
-fetch_data(get_testing_files_dict(), keys=['processing.zip'])
-tmp_dir = tempfile.TemporaryDirectory()
+
+@pytest.fixture(scope='session', autouse=True)
+def fetch_test_data():
+    # If they already exist, this only takes 5 seconds (check md5sum)
+    fetch_data(get_testing_files_dict(), keys=['processing.zip'])
+
+
+@pytest.fixture(scope='session')
+def tmp_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yield tmp_dir
 
 
 def test_help_option(script_runner):
@@ -16,8 +25,8 @@ def test_help_option(script_runner):
     assert ret.success
 
 
-def test_execution_processing(script_runner):
-    os.chdir(os.path.expanduser(tmp_dir.name))
+def test_execution_processing(script_runner, tmp_dir):
+    os.chdir(os.path.expanduser(tmp_dir))
     in_sh = os.path.join(get_home(), 'processing',
                           'sh.nii.gz')
     ret = script_runner.run('scil_compute_rish_from_sh.py', in_sh, 'rish.nii.gz')
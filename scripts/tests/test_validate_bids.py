@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import json
+import multiprocessing
 import nibabel as nib
 import numpy as np
 import os
@@ -434,3 +435,137 @@ def test_bids_rev_dwi_sbref(
         assert compare_jsons(json_output, test_dir)
     else:
         assert False
+
+
+def _get_json_subjects(json_path):
+    with open(json_path, 'r') as f:
+        return sorted(row['subject'] for row in json.load(f))
+
+
+def test_bids_participants(tmpdir, script_runner):
+    test_dir = generate_fake_bids_structure(
+        tmpdir, 3, 1,
+        gen_anat_t1=True,
+        gen_epi=True)
+    json_output = os.path.join(test_dir, 'test_participants.json')
+
+    ret = script_runner.run(
+        'scil_validate_bids.py',
+        test_dir,
+        json_output,
+        '--participants', '2', 'sub-3',
+        '-f', '-v')
+
+    assert ret.success
+    assert _get_json_subjects(json_output) == ['2', '3']
+
+
+def test_bids_layout_db(tmpdir, script_runner):
+    test_dir = generate_fake_bids_structure(
+        tmpdir, 3, 1,
+        gen_anat_t1=True,
+        gen_epi=True)
+    layout_db = os.path.join(str(tmpdir), 'layout_db')
+    json_output = os.path.join(test_dir, 'test_layout_db.json')
+
+    # First run indexes the dataset and saves the database
+    ret = script_runner.run(
+        'scil_validate_bids.py',
+        test_dir,
+        json_output,
+        '--layout_db', layout_db,
+        '-f', '-v')
+
+    assert ret.success
+    assert os.path.isdir(layout_db)
+    assert _get_json_subjects(json_output) == ['1', '2', '3']
+
+    # Second run loads the database, participants must still be filtered
+    ret = script_runner.run(
+        'scil_validate_bids.py',
+        test_dir,
+        json_output,
+        '--layout_db', layout_db,
+        '--participants', '1',
+        '-f', '-v')
+
+    assert ret.success
+    assert _get_json_subjects(json_output) == ['1']
+
+
+def test_bids_ignore_option(tmpdir, script_runner):
+    test_dir = generate_fake_bids_structure(
+        tmpdir, 3, 1,
+        gen_anat_t1=True,
+        gen_epi=True)
+    json_output = os.path.join(test_dir, 'test_bids_ignore.json')
+
+    # A glob with a character class is matched by the combined regex
+    bids_ignore = os.path.join(str(tmpdir), 'extra_bidsignore')
+    with open(bids_ignore, 'w') as f:
+        f.write('# Ignored subjects\n\nsub-[2]*\n')
+
+    ret = script_runner.run(
+        'scil_validate_bids.py',
+        test_dir,
+        json_output,
+        '--bids_ignore', bids_ignore,
+        '-f', '-v')
+
+    assert ret.success
+    assert _get_json_subjects(json_output) == ['1', '3']
+
+
+def test_bids_ignore_file(tmpdir, script_runner):
+    test_dir = generate_fake_bids_structure(
+        tmpdir, 3, 1,
+        gen_anat_t1=True,
+        gen_epi=True)
+    json_output = os.path.join(str(tmpdir), 'test_bidsignore_file.json')
+
+    # Literal rules are matched as suffixes and '*literal*' as substrings
+    with open(os.path.join(test_dir, '.bidsignore'), 'w') as f:
+        f.write('# Ignored subjects\nsub-2\n*sub-3*\n')
+
+    ret = script_runner.run(
+        'scil_validate_bids.py',
+        test_dir,
+        json_output,
+        '-f', '-v')
+
+    assert ret.success
+    assert _get_json_subjects(json_output) == ['1']
+
+
+@pytest.mark.skipif(multiprocessing.cpu_count() < 2,
+                    reason='Requires at least 2 CPUs.')
+@pytest.mark.parametrize(
+    "gen_epi,gen_rev_dwi",
+    [(True, False),
+     (False, True)]
+)
+def test_bids_processes(tmpdir, script_runner, gen_epi, gen_rev_dwi):
+    test_dir = generate_fake_bids_structure(
+        tmpdir, 3, 2,
+        gen_anat_t1=True,
+        gen_epi=gen_epi,
+        gen_rev_dwi=gen_rev_dwi)
+
+    outputs = []
+    for nbr_processes in ['1', '2']:
+        json_output = os.path.join(
+            str(tmpdir), 'test_processes_{}.json'.format(nbr_processes))
+        ret = script_runner.run(
+            'scil_validate_bids.py',
+            test_dir,
+            json_output,
+            '--processes', nbr_processes,
+            '-f', '-v')
+        assert ret.success
+
+        with open(json_output, 'r') as f:
+            outputs.append(json.load(f))
+
+    # Subjects are validated in parallel but written in the same order
+    assert len(outputs[0]) == 6
+    assert outputs[0] == outputs[1]